@@ -0,0 +1,103 @@
+"""
+Semantic cache of final answers, keyed on the embedding of the formulated question
+"""
+import os
+import json
+import time
+import uuid
+import logging
+from typing import Dict, Any, Optional, Tuple
+
+import numpy as np
+from blake3 import blake3
+
+from langchain_core.documents import Document
+from langchain_chroma import Chroma
+
+from document_store import CHROMA_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_DIR = os.path.join(CHROMA_CACHE_DIR, "answers")
+ANSWER_COLLECTION_NAME = "rag_answer_cache"
+# Cosine distance below which two questions are treated as the same (~0.95 similarity)
+MAX_DISTANCE = 0.05
+# Stricter threshold (~0.97 similarity) for raw user input, which is looked up before any
+# question formulation and so must be a near-verbatim repeat
+RAW_INPUT_MAX_DISTANCE = 0.03
+ANSWER_TTL_SECONDS = 7 * 24 * 3600
+# Expired entries are swept on start-up and then at most this often, from store()
+SWEEP_INTERVAL_SECONDS = 3600
+
+def answer_scope(entry_point: str, prompt_template: str, **settings) -> str:
+    """
+    Identifies the pipeline an answer came from: entry point, prompt text and retrieval settings.
+    Answers are only reused within the same scope.
+    """
+    params = ",".join(f"{name}={settings[name]}" for name in sorted(settings))
+    return f"{entry_point}|{blake3(prompt_template.encode('utf-8')).hexdigest()[:16]}|{params}"
+
+class AnswerCache:
+    """Stores structured answers per document and returns them for identical or paraphrased questions."""
+    def __init__(self, embeddings, max_distance: float = MAX_DISTANCE, ttl_seconds: int = ANSWER_TTL_SECONDS):
+        self.embeddings = embeddings
+        self.max_distance = max_distance
+        self.ttl_seconds = ttl_seconds
+        self._store = Chroma(
+            collection_name=ANSWER_COLLECTION_NAME,
+            persist_directory=ANSWER_CACHE_DIR,
+            embedding_function=embeddings,
+            collection_metadata={"hnsw:space": "cosine"}
+        )
+        self.sweep()
+
+    def sweep(self) -> None:
+        """Deletes entries older than the TTL."""
+        self._last_sweep = time.time()
+        cutoff = self._last_sweep - self.ttl_seconds
+        self._store._collection.delete(where={"timestamp": {"$lt": cutoff}})
+
+    def lookup(self, document_hash: str, scope: str, question: str, vector: Optional[np.ndarray] = None, max_distance: Optional[float] = None) -> Tuple[Optional[Dict[str, Any]], np.ndarray]:
+        """
+        Returns (cached answer or None, question embedding as a float32 array).
+        Only answers stored under the same `scope` (see answer_scope) are considered.
+        Pass `vector` when the question is already embedded. The embedding is handed back
+        so retrieval and a later store() can reuse it instead of embedding the question again.
+        """
+        if vector is None:
+            vector = self.embeddings.embed_query(question)
+        vector = np.asarray(vector, dtype=np.float32)
+        result = self._store._collection.query(
+            query_embeddings=[vector],
+            n_results=1,
+            where={"$and": [
+                {"document_hash": document_hash},
+                {"scope": scope},
+                {"timestamp": {"$gte": time.time() - self.ttl_seconds}}
+            ]}
+        )
+        if max_distance is None:
+            max_distance = self.max_distance
+        if not result["ids"][0] or result["distances"][0][0] >= max_distance:
+            return None, vector
+
+        logger.info(f"⚡ Answer cache hit (distance {result['distances'][0][0]:.4f})")
+        answer = json.loads(result["documents"][0][0])
+        answer["source_documents"] = [Document(**doc) for doc in answer.get("source_documents", [])]
+        return answer, vector
+
+    def store(self, document_hash: str, scope: str, question: str, vector: np.ndarray, answer: Dict[str, Any]) -> None:
+        # A long-running Streamlit process would otherwise only ever sweep once
+        if time.time() - self._last_sweep >= SWEEP_INTERVAL_SECONDS:
+            self.sweep()
+        payload = dict(answer)
+        payload["source_documents"] = [
+            {"page_content": doc.page_content, "metadata": doc.metadata}
+            for doc in answer.get("source_documents", [])
+        ]
+        self._store._collection.add(
+            ids=[str(uuid.uuid4())],
+            documents=[json.dumps(payload)],
+            embeddings=[np.asarray(vector, dtype=np.float32)],
+            metadatas=[{"document_hash": document_hash, "scope": scope, "question": question, "timestamp": time.time()}]
+        )
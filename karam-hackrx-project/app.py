@@ -1,90 +1,121 @@
 import os
-import json
-import tempfile
+from functools import lru_cache
+from typing import Any, Dict, Generator
 from dotenv import load_dotenv
 
 from langchain_openai import AzureOpenAIEmbeddings, AzureChatOpenAI
 from langchain_core.prompts import PromptTemplate
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
+
+from document_store import EMBEDDING_DIMENSIONS, document_hash, format_docs, get_vectorstore
+from answer_cache import RAW_INPUT_MAX_DISTANCE, AnswerCache, answer_scope
+from http_pool import shared_async_http, shared_http
+from streaming import drain
+from prompts import PROMPT_CACHE_USER, RAG_PROMPT_TEMPLATE, cached_formulator, extract_json, is_ready_question
 
 load_dotenv()
 
-def get_policy_analysis(uploaded_file, user_input: str):
-    """
-    Processes an uploaded document and a user query to return a structured answer.
-    """
-    # --- Initialize LLM and Embeddings Clients ---
+FORMULATION_PROMPT = PromptTemplate.from_template(
+    "Convert the user's statement of facts into a clear, answerable question about insurance coverage.\n\n"
+    "User Statement: \"{user_input}\"\n"
+    "Question:"
+)
+
+@lru_cache(maxsize=1)
+def _get_clients():
+    """Creates the Azure clients once per process so their connection pools are reused across requests."""
     llm = AzureChatOpenAI(
         azure_deployment="gpt-4o-mini",
         openai_api_version="2024-02-01",
         temperature=0,
+        model_kwargs={"user": PROMPT_CACHE_USER},
         api_key=os.getenv("GENERATION_AZURE_API_KEY"),
-        azure_endpoint=os.getenv("GENERATION_AZURE_ENDPOINT")
+        azure_endpoint=os.getenv("GENERATION_AZURE_ENDPOINT"),
+        http_client=shared_http,
+        http_async_client=shared_async_http
     )
     azure_embeddings = AzureOpenAIEmbeddings(
         azure_deployment="text-embedding-3-small",
+        dimensions=EMBEDDING_DIMENSIONS,
         openai_api_version="2024-02-01",
         api_key=os.getenv("EMBEDDING_AZURE_API_KEY"),
-        azure_endpoint=os.getenv("EMBEDDING_AZURE_ENDPOINT")
+        azure_endpoint=os.getenv("EMBEDDING_AZURE_ENDPOINT"),
+        http_client=shared_http,
+        http_async_client=shared_async_http
     )
+    return llm, azure_embeddings
 
-    # --- Step 1: Formulate a clear question from the user's input ---
-    formulation_prompt = PromptTemplate.from_template(
-        "Convert the user's statement of facts into a clear, answerable question about insurance coverage.\n\n"
-        "User Statement: \"{user_input}\"\n"
-        "Question:"
-    )
-    question_formulation_chain = formulation_prompt | llm
-    formulated_question = question_formulation_chain.invoke({"user_input": user_input}).content
+# Cached answers from this pipeline are kept apart from dynamic.py's, which use other settings and shapes
+_ANSWER_SCOPE = answer_scope("app", RAG_PROMPT_TEMPLATE, max_chunks=5, chunk_size=1000, chunk_overlap=100)
+
+@lru_cache(maxsize=1)
+def _get_answer_cache() -> AnswerCache:
+    return AnswerCache(_get_clients()[1])
+
+@lru_cache(maxsize=1)
+def _get_formulation_chain():
+    """Built on first use and shared by every request."""
+    return FORMULATION_PROMPT | _get_clients()[0]
+
+_formulate = cached_formulator(_get_formulation_chain)
+
+def get_policy_analysis(pdf_bytes: bytes, user_input: str, on_token=None, doc_hash: str = None):
+    """
+    Processes an uploaded document's bytes and a user query to return a structured answer.
+    `on_token`, if given, is called with the answer text accumulated so far while it streams in.
+    Pass `doc_hash` when the caller has already hashed the bytes.
+    """
+    return drain(stream_policy_analysis(pdf_bytes, user_input, doc_hash), on_token)
+
+def stream_policy_analysis(pdf_bytes: bytes, user_input: str, doc_hash: str = None) -> Generator[str, None, Dict[str, Any]]:
+    """
+    Same pipeline as get_policy_analysis, but yields the answer text as it streams in, one
+    new piece at a time (suitable for st.write_stream). The structured answer is the generator's return value.
+    """
+    # --- Shared LLM and Embeddings Clients ---
+    llm, azure_embeddings = _get_clients()
 
-    # --- Step 2: Load Document and Perform RAG ---
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            tmp_file_path = tmp_file.name
-        
-        loader = PyPDFLoader(tmp_file_path)
-        docs = loader.load()
-        os.remove(tmp_file_path)
+        doc_hash = doc_hash or document_hash(pdf_bytes)
+        answer_cache = _get_answer_cache()
 
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-        chunks = text_splitter.split_documents(docs)
-        
-        vectorstore = Chroma.from_documents(documents=chunks, embedding=azure_embeddings)
-        retriever = vectorstore.as_retriever(search_kwargs={'k': 5})
-
-        rag_prompt_template = """
-        You are an insurance policy analyst. Based ONLY on the CONTEXT provided, answer the user's QUESTION.
-        Generate a JSON object with this exact schema: {{"decision": "yes/no/partially", "amount": "coverage amount or 'Not Specified'", "justification": "explanation quoting the context", "source_clause": "the clause number"}}
-        CONTEXT:{context}
-        QUESTION:{question}
-        ANSWER (in JSON format):
-        """
-        rag_prompt = PromptTemplate.from_template(rag_prompt_template)
-        rag_chain = ({
-            "context": retriever, 
-            "question": lambda x: formulated_question
-        } | rag_prompt | llm)
-
-        response_from_llm = rag_chain.invoke(user_input) # Pass original input
-        
-        # --- Step 3: Parse and Finalize Response ---
-        json_start = response_from_llm.content.find('{')
-        json_end = response_from_llm.content.rfind('}') + 1
-        json_string = response_from_llm.content[json_start:json_end]
-        structured_response = json.loads(json_string)
-
-        summary_prompt = PromptTemplate.from_template(
-            "Based on the analysis that the decision is '{decision}', provide a simple, one-sentence conversational answer."
+        # --- Step 1: A near-verbatim repeat of an earlier input (e.g. a preset button) is answered from cache ---
+        cached_answer, input_vector = answer_cache.lookup(doc_hash, _ANSWER_SCOPE, user_input, max_distance=RAW_INPUT_MAX_DISTANCE)
+        if cached_answer is not None:
+            return cached_answer
+
+        # --- Step 2: Formulate a clear question from the user's input ---
+        formulated_question = user_input if is_ready_question(user_input) else _formulate(user_input)
+        cached_answer, question_vector = answer_cache.lookup(
+            doc_hash, _ANSWER_SCOPE, formulated_question, input_vector if formulated_question == user_input else None
         )
-        summary_chain = summary_prompt | llm
-        conversational_summary = summary_chain.invoke(structured_response).content
+        if cached_answer is not None:
+            return cached_answer
+
+        # --- Step 3: Load Document and Perform RAG ---
+        # Cached per document content, so repeat uploads skip parsing and embedding
+        index, _ = get_vectorstore(pdf_bytes, azure_embeddings, doc_hash=doc_hash)
+
+        rag_prompt = PromptTemplate.from_template(RAG_PROMPT_TEMPLATE)
+
+        # The top five chunks are both the prompt context and the evidence returned with the answer
+        source_documents = index.search(question_vector, 5)
+        response_content = ""
+        for chunk in (rag_prompt | llm).stream({
+            "context": format_docs(source_documents),
+            "question": formulated_question
+        }):
+            response_content += chunk.content
+            yield chunk.content
+        
+        # --- Step 4: Parse and Finalize Response ---
+        structured_response = extract_json(response_content)
         
+        # conversational_summary comes back in the same JSON, no second LLM call
         final_response = structured_response
-        final_response["conversational_summary"] = conversational_summary
-        final_response["source_documents"] = retriever.invoke(formulated_question)
+        final_response["source_documents"] = source_documents
+        answer_cache.store(doc_hash, _ANSWER_SCOPE, formulated_question, question_vector, final_response)
+        if formulated_question != user_input:
+            answer_cache.store(doc_hash, _ANSWER_SCOPE, user_input, input_vector, final_response)
         
         return final_response
 
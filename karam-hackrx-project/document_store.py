@@ -0,0 +1,401 @@
+"""
+Shared PDF loading, vector store caching and retrieval for app.py and dynamic.py
+"""
+import os
+import math
+import asyncio
+import random
+import re
+import logging
+import threading
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Tuple
+
+import fitz
+import numpy as np
+from blake3 import blake3
+from langchain_core.documents import Document
+from langchain_chroma import Chroma
+
+from embedding_cache import EmbeddingCache
+from http_pool import run_async
+
+# Optional: compiles the chunking loop to machine code; the pure Python loop is used without it
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+logger = logging.getLogger(__name__)
+
+# text-embedding-3-small truncated to 512 dimensions (Matryoshka), a third of the default size
+EMBEDDING_DIMENSIONS = 512
+# One cache directory shared by every entry point; each document gets a sub-directory.
+# Versioned by embedding size so vectors of different dimensions never mix.
+CHROMA_CACHE_DIR = os.path.join("chroma_cache", f"v2_{EMBEDDING_DIMENSIONS}")
+COLLECTION_NAME = "policy_chunks"
+# Chunks sent to the embeddings endpoint per request
+EMBEDDING_BATCH_SIZE = 256
+# Chunks written to Chroma per add() call; each call is one SQLite transaction plus an HNSW update
+INSERT_BATCH_SIZE = 200
+EMBEDDING_CACHE_PATH = os.path.join(CHROMA_CACHE_DIR, "embeddings.sqlite3")
+
+# Content-defined chunking: a 64-bit gear hash covers the last 64 characters, and a
+# boundary is picked where it falls below a threshold. Boundaries depend only on nearby
+# text, so an edit near the top of a document no longer shifts every later chunk.
+_gear_rng = random.Random(2648)
+_GEAR = [_gear_rng.getrandbits(64) for _ in range(256)]
+_HASH_BITS = 0xFFFFFFFFFFFFFFFF
+_GEAR_ARRAY = np.array(_GEAR, dtype=np.uint64)
+_WHITESPACE = re.compile(r"\s")
+# Blocks found on more than this share of pages are treated as headers/footers
+REPEATED_BLOCK_RATIO = 0.6
+
+def document_hash(pdf_bytes: bytes) -> str:
+    """Content hash used to identify an uploaded document across requests (BLAKE3, several times faster than SHA-256)."""
+    return blake3(pdf_bytes).hexdigest()
+
+def format_docs(docs) -> str:
+    """Joins retrieved chunks into the CONTEXT block of the RAG prompt."""
+    return "\n\n".join(doc.page_content for doc in docs)
+
+def _normalize_block(text: str) -> str:
+    # Page numbers differ per page, so digits are ignored when matching repeated blocks
+    return re.sub(r"\d+", "#", " ".join(text.split()).lower())
+
+def load_pdf(pdf_bytes: bytes) -> List[Document]:
+    """
+    Extracts one Document per page straight from the in-memory bytes, no temp file needed.
+    Text blocks that repeat on more than REPEATED_BLOCK_RATIO of the pages (headers,
+    footers, page numbers) are dropped so they are not chunked and embedded again and again.
+    """
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf:
+        # Block tuples are (x0, y0, x1, y1, text, block_no, block_type); type 0 is text
+        pages = [[b[4] for b in page.get_text("blocks") if b[6] == 0] for page in pdf]
+        page_count = pdf.page_count
+
+    block_counts = Counter(key for blocks in pages for key in {_normalize_block(b) for b in blocks})
+    repeated = {key for key, count in block_counts.items() if page_count > 1 and count / page_count > REPEATED_BLOCK_RATIO}
+    return [
+        Document(
+            page_content="\n".join(b for b in blocks if _normalize_block(b) not in repeated),
+            metadata={"page": number, "total_pages": page_count}
+        )
+        for number, blocks in enumerate(pages)
+    ]
+
+@lru_cache(maxsize=64)
+def _cut_threshold(chunk_size: int) -> int:
+    """
+    Hash value below which a chunk boundary is taken, chosen so chunks average ~chunk_size.
+    With cut probability 1/x per character past min_size and the hard cap at max_size, the
+    expected extra length is x * (1 - exp(-span / x)); x is solved for by bisection.
+    """
+    min_size, max_size = chunk_size // 2, int(chunk_size * 1.2)
+    span, target = max_size - min_size, chunk_size - min_size
+    low, high = 1.0, 64.0 * max(target, 1)
+    for _ in range(60):
+        x = (low + high) / 2
+        if x * (1 - math.exp(-span / x)) < target:
+            low = x
+        else:
+            high = x
+    return max(1, int(_HASH_BITS / high))
+
+def _chunk_offsets(codes: np.ndarray, spaces: np.ndarray, gear: np.ndarray, min_size: int, max_size: int, threshold: np.uint64) -> np.ndarray:
+    """Array version of the _chunk_boundaries loop, compiled with numba when it is installed."""
+    n = codes.shape[0]
+    # Every chunk but the last is at least min_size long, which bounds the output
+    boundaries = np.empty(n // min_size + 1, dtype=np.int64)
+    count, start, h, pending, last_space = 0, 0, np.uint64(0), False, -1
+    for i in range(n):
+        # uint64 arithmetic wraps, so no explicit 64-bit mask is needed
+        h = (h << np.uint64(1)) + gear[codes[i] & 0xFF]
+        is_space = spaces[i]
+        if is_space:
+            last_space = i
+        length = i + 1 - start
+        if length < min_size:
+            continue
+        pending = pending or h < threshold
+        if pending and is_space:
+            end = i + 1
+        elif length >= max_size:
+            end = last_space + 1 if last_space >= start + min_size else i + 1
+        else:
+            continue
+        boundaries[count] = end
+        count += 1
+        start, pending = end, False
+    if start < n:
+        boundaries[count] = n
+        count += 1
+    return boundaries[:count]
+
+if njit is not None:
+    # nogil lets chunking overlap embedding requests in other threads; cache=True keeps the
+    # compiled code in __pycache__ so only the first run after install pays for compilation
+    _chunk_offsets = njit(nogil=True, cache=True)(_chunk_offsets)
+
+def _chunk_boundaries(text: str, chunk_size: int) -> List[int]:
+    """
+    End offsets of content-defined chunks averaging roughly chunk_size characters.
+    Single pass over the text; no chunk is longer than 1.2 * chunk_size, even for
+    whitespace-free runs such as tables or OCR blobs.
+    """
+    min_size, max_size = chunk_size // 2, int(chunk_size * 1.2)
+    threshold = _cut_threshold(chunk_size)
+
+    if njit is not None:
+        # One code point per character, so offsets match the str indices
+        codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+        spaces = np.fromiter(map(str.isspace, text), dtype=np.bool_, count=len(text))
+        return _chunk_offsets(codes, spaces, _GEAR_ARRAY, max(1, min_size), max_size, np.uint64(threshold)).tolist()
+
+    boundaries, start, h, pending, last_space = [], 0, 0, False, -1
+    for i, ch in enumerate(text):
+        h = ((h << 1) + _GEAR[ord(ch) & 0xFF]) & _HASH_BITS
+        is_space = ch.isspace()
+        if is_space:
+            last_space = i
+        length = i + 1 - start
+        if length < min_size:
+            continue
+        pending = pending or h < threshold
+        # Cut on the next whitespace after a hash match so words are never split
+        if pending and is_space:
+            end = i + 1
+        elif length >= max_size:
+            # Hard cap: wrap at the last whitespace in the chunk, or mid-token if there is none
+            end = last_space + 1 if last_space >= start + min_size else i + 1
+        else:
+            continue
+        boundaries.append(end)
+        start, pending = end, False
+    if start < len(text):
+        boundaries.append(len(text))
+    return boundaries
+
+def split_documents(docs: List[Document], chunk_size: int = 1000, chunk_overlap: int = 100) -> List[Document]:
+    """
+    Splits each page at content-defined boundaries; each chunk also carries up to chunk_overlap
+    characters before it, starting at a word boundary.
+    """
+    chunks = []
+    for doc in docs:
+        text, start = doc.page_content, 0
+        for end in _chunk_boundaries(text, chunk_size):
+            overlap_start = max(0, start - chunk_overlap)
+            # Move a mid-word overlap start forward to the next whitespace so chunks never open on a word fragment
+            if overlap_start > 0 and not text[overlap_start - 1].isspace():
+                space = _WHITESPACE.search(text, overlap_start, start)
+                overlap_start = space.end() if space else start
+            piece = text[overlap_start:end].strip()
+            if piece:
+                chunks.append(Document(page_content=piece, metadata=dict(doc.metadata)))
+            start = end
+    return chunks
+
+def load_and_split_pdf(pdf_bytes: bytes, chunk_size: int = 1000, chunk_overlap: int = 100):
+    """Parses the PDF bytes and splits them into chunks. Returns (pages, chunks)."""
+    docs = load_pdf(pdf_bytes)
+    return docs, split_documents(docs, chunk_size, chunk_overlap)
+
+async def _embed_batches(embeddings, batches: List[List[str]]) -> List[np.ndarray]:
+    """
+    Sends every batch to the embeddings endpoint at once instead of one after another.
+    Each batch comes back as one float32 matrix; the SDK's lists of Python floats are dropped right away.
+    """
+    results = await asyncio.gather(*[embeddings.aembed_documents(batch) for batch in batches], return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return [np.asarray(result, dtype=np.float32) for result in results]
+
+@lru_cache(maxsize=1)
+def _get_embedding_cache() -> EmbeddingCache:
+    return EmbeddingCache(EMBEDDING_CACHE_PATH)
+
+def ingest_chunks_batched(collection, texts: List[str], vectors: List[np.ndarray], metas: List[Dict[str, Any]], batch_size: int = INSERT_BATCH_SIZE) -> None:
+    """Writes precomputed chunk embeddings into the collection, one add() per batch."""
+    for i in range(0, len(texts), batch_size):
+        collection.add(
+            ids=[f"chunk-{j}" for j in range(i, min(i + batch_size, len(texts)))],
+            documents=texts[i:i + batch_size],
+            embeddings=vectors[i:i + batch_size],
+            metadatas=metas[i:i + batch_size]
+        )
+
+def _embedding_model_id(embeddings) -> str:
+    return f"{getattr(embeddings, 'deployment', None) or embeddings.model}/{embeddings.dimensions}"
+
+def cached_embed(texts: List[str], embeddings, batch_size: int = EMBEDDING_BATCH_SIZE) -> List[np.ndarray]:
+    """
+    Returns one float32 vector per text. Texts embedded before by the same model, in any
+    document or process, come from the embedding cache; the misses go to the API in
+    concurrent batches and are written back.
+    """
+    model = _embedding_model_id(embeddings)
+    keys = [EmbeddingCache.key(t, model) for t in texts]
+
+    cache = _get_embedding_cache()
+    vectors = cache.get_many(list(set(keys)))
+    missing = {k: t for k, t in zip(keys, texts) if k not in vectors}
+    if missing:
+        miss_keys, miss_texts = list(missing), list(missing.values())
+        starts = range(0, len(miss_texts), batch_size)
+        batch_vectors = run_async(_embed_batches(embeddings, [miss_texts[i:i + batch_size] for i in starts]))
+        new_vectors = dict(zip(miss_keys, (v for batch in batch_vectors for v in batch)))
+        cache.put_many(new_vectors)
+        vectors.update(new_vectors)
+    logger.info(f"🧮 Embedded {len(missing)} new texts, {len(set(keys)) - len(missing)} reused from cache")
+
+    return [np.asarray(vectors[k], dtype=np.float32) for k in keys]
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-vector int8 quantization. Returns (codes, scales) with vectors ≈ codes * scales[:, None]."""
+    vectors = np.atleast_2d(vectors)
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+class VectorIndex:
+    """
+    In-memory copy of a document's chunk embeddings, searched with a single matrix product.
+    Vectors are kept as int8 codes plus one float scale each, a quarter of the float32 size.
+    """
+    def __init__(self, documents: List[Document], vectors, stats: Dict[str, Any]):
+        self.documents = documents
+        self.stats = stats
+        matrix = np.asarray(vectors, dtype=np.float32)
+        self.codes, self.scales = quantize_int8(matrix / np.linalg.norm(matrix, axis=1, keepdims=True))
+
+    def top_ids(self, query_vector, k: int) -> np.ndarray:
+        """Row ids of the k chunks most similar to the query, best first."""
+        query_codes, query_scale = quantize_int8(np.asarray(query_vector, dtype=np.float32))
+        # Ranking only needs relative order, so the query is not normalised; numpy has no
+        # int8 GEMM, the codes are widened to float32 for the product (exact for int8 values)
+        scores = (self.codes @ query_codes[0].astype(np.float32)) * (self.scales * query_scale[0])
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])]
+
+    def vectors(self, ids: np.ndarray) -> np.ndarray:
+        """Dequantised unit vectors for the given rows, as one contiguous float32 matrix."""
+        return np.ascontiguousarray(self.codes[ids] * self.scales[ids, None], dtype=np.float32)
+
+    def search(self, query_vector, k: int) -> List[Document]:
+        return [self.documents[i] for i in self.top_ids(query_vector, k)]
+
+
+# VectorIndex per persist directory, most recently used last
+_INDEX_CACHE: "OrderedDict[str, VectorIndex]" = OrderedDict()
+_INDEX_CACHE_SIZE = 32
+# Streamlit runs each session in its own thread: one lock guards the OrderedDict, and one
+# lock per persist directory keeps two sessions from loading or building the same store at once
+_INDEX_CACHE_LOCK = threading.Lock()
+_BUILD_LOCKS: Dict[str, threading.Lock] = {}
+
+def _cached_index(persist_directory: str) -> Optional[VectorIndex]:
+    with _INDEX_CACHE_LOCK:
+        index = _INDEX_CACHE.get(persist_directory)
+        if index is not None:
+            _INDEX_CACHE.move_to_end(persist_directory)
+        return index
+
+def _cache_index(persist_directory: str, index: VectorIndex) -> VectorIndex:
+    with _INDEX_CACHE_LOCK:
+        _INDEX_CACHE[persist_directory] = index
+        _INDEX_CACHE.move_to_end(persist_directory)
+        while len(_INDEX_CACHE) > _INDEX_CACHE_SIZE:
+            _INDEX_CACHE.popitem(last=False)
+    return index
+
+def _build_lock(persist_directory: str) -> threading.Lock:
+    with _INDEX_CACHE_LOCK:
+        return _BUILD_LOCKS.setdefault(persist_directory, threading.Lock())
+
+def _load_index(persist_directory: str) -> Optional[VectorIndex]:
+    """
+    Reads a persisted collection into memory. Returns None when the collection is empty
+    or holds fewer chunks than were recorded at build time, e.g. after a killed build.
+    """
+    collection = Chroma(persist_directory=persist_directory, collection_name=COLLECTION_NAME)._collection
+    stats = collection.metadata or {}
+    count = collection.count()
+    if count == 0 or count != stats.get("chunk_count", count):
+        return None
+
+    data = collection.get(include=["documents", "metadatas", "embeddings"])
+    documents = [Document(page_content=text, metadata=meta or {}) for text, meta in zip(data["documents"], data["metadatas"])]
+    return VectorIndex(documents, data["embeddings"], {
+        "total_pages": stats.get("total_pages", 0),
+        "chunk_count": count
+    })
+
+def _drop_collection(persist_directory: str) -> None:
+    """
+    Deletes the chunk collection through Chroma's own client. Chroma keeps one client per
+    persist_directory for the life of the process, so removing the files under it would
+    leave that client pointing at a deleted SQLite file and break every later rebuild.
+    """
+    Chroma(persist_directory=persist_directory, collection_name=COLLECTION_NAME).delete_collection()
+
+def get_vectorstore(pdf_bytes: bytes, embeddings, chunk_size: int = 1000, chunk_overlap: int = 100, insert_batch_size: int = INSERT_BATCH_SIZE, doc_hash: Optional[str] = None) -> Tuple[VectorIndex, Dict[str, Any]]:
+    """
+    Returns the in-memory VectorIndex for the document, backed by a persisted Chroma store
+    that is built only on the first upload. Repeat uploads of the same bytes skip parsing,
+    splitting and embedding entirely, and queries never touch SQLite or HNSW.
+    Pass `doc_hash` when the caller has already hashed the bytes.
+    """
+    doc_hash = doc_hash or document_hash(pdf_bytes)
+    persist_directory = os.path.join(CHROMA_CACHE_DIR, f"{doc_hash}-{chunk_size}-{chunk_overlap}")
+
+    # Hot path: the index is already in memory, no filesystem or Chroma access at all
+    index = _cached_index(persist_directory)
+    if index is not None:
+        return index, {"document_hash": doc_hash, **index.stats}
+
+    with _build_lock(persist_directory):
+        # Another session may have loaded or built this store while we waited for the lock
+        index = _cached_index(persist_directory) or _load_or_build(
+            persist_directory, doc_hash, pdf_bytes, embeddings, chunk_size, chunk_overlap, insert_batch_size
+        )
+    return index, {"document_hash": doc_hash, **index.stats}
+
+def _load_or_build(persist_directory: str, doc_hash: str, pdf_bytes: bytes, embeddings, chunk_size: int, chunk_overlap: int, insert_batch_size: int) -> VectorIndex:
+    """Opens the persisted store or builds it, and caches the index. Call with the directory's build lock held."""
+    index = None
+    if os.path.isdir(persist_directory):
+        index = _load_index(persist_directory)
+        if index is not None:
+            logger.info(f"♻️ Loaded cached vector store for {doc_hash[:12]}")
+        else:
+            logger.warning(f"⚠️ Discarding incomplete vector store for {doc_hash[:12]}")
+            _drop_collection(persist_directory)
+
+    if index is None:
+        logger.info(f"📚 Building vector store for {doc_hash[:12]}")
+        docs, chunks = load_and_split_pdf(pdf_bytes, chunk_size, chunk_overlap)
+        stats = {"total_pages": len(docs), "chunk_count": len(chunks)}
+        texts = [c.page_content for c in chunks]
+        # Embed before touching Chroma, so a rate limit or timeout from Azure leaves nothing on disk
+        vectors = cached_embed(texts, embeddings)
+        try:
+            vectorstore = Chroma(
+                embedding_function=embeddings,
+                persist_directory=persist_directory,
+                collection_name=COLLECTION_NAME,
+                collection_metadata={**stats, "hnsw:space": "cosine"}
+            )
+            ingest_chunks_batched(vectorstore._collection, texts, vectors, [c.metadata for c in chunks], insert_batch_size)
+        except Exception:
+            # Never leave a half-built store behind
+            _drop_collection(persist_directory)
+            raise
+        # Index straight from the vectors just written instead of reopening the store
+        index = VectorIndex(chunks, vectors, stats)
+
+    return _cache_index(persist_directory, index)
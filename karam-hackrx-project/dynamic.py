@@ -7,20 +7,25 @@ except ImportError:
     pass
 
 import os
-import json
-import tempfile
+import re
+import queue
+import asyncio
 import logging
 from datetime import datetime
-from typing import Dict, List, Any
+from functools import lru_cache
+from typing import Dict, Generator, List, Any
+import numpy as np
 from dotenv import load_dotenv
 
 # --- Imports ---
 from langchain_openai import AzureOpenAIEmbeddings, AzureChatOpenAI
 from langchain_core.prompts import PromptTemplate
-from langchain_core.runnables import RunnablePassthrough
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
+
+from document_store import EMBEDDING_DIMENSIONS, INSERT_BATCH_SIZE, document_hash, format_docs, get_vectorstore
+from answer_cache import AnswerCache, answer_scope
+from http_pool import require_pool_loop, run_async, shared_async_http, shared_http, submit_async
+from streaming import drain
+from prompts import PROMPT_CACHE_USER, RAG_PROMPT_TEMPLATE, cached_formulator, extract_json, is_ready_question
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
@@ -32,99 +37,193 @@ class DocumentProcessor:
         try:
             self.azure_embeddings = AzureOpenAIEmbeddings(
                 azure_deployment="text-embedding-3-small",
+                dimensions=EMBEDDING_DIMENSIONS,
                 openai_api_version="2024-02-01",
                 api_key=os.getenv("EMBEDDING_AZURE_API_KEY"),
-                azure_endpoint=os.getenv("EMBEDDING_AZURE_ENDPOINT")
+                azure_endpoint=os.getenv("EMBEDDING_AZURE_ENDPOINT"),
+                http_client=shared_http,
+                http_async_client=shared_async_http
             )
             self.llm = AzureChatOpenAI(
                 azure_deployment="gpt-4o-mini",
                 openai_api_version="2024-02-01",
                 temperature=0,
+                model_kwargs={"user": PROMPT_CACHE_USER},
                 api_key=os.getenv("GENERATION_AZURE_API_KEY"),
-                azure_endpoint=os.getenv("GENERATION_AZURE_ENDPOINT")
+                azure_endpoint=os.getenv("GENERATION_AZURE_ENDPOINT"),
+                http_client=shared_http,
+                http_async_client=shared_async_http
             )
             logger.info("✅ Azure OpenAI services initialized successfully")
         except Exception as e:
             raise ValueError(f"❌ Failed to initialize Azure OpenAI services: {str(e)}")
 
+@lru_cache(maxsize=1)
+def get_processor() -> DocumentProcessor:
+    """Process-wide DocumentProcessor, created on first use."""
+    return DocumentProcessor()
+
+@lru_cache(maxsize=1)
+def _get_answer_cache() -> AnswerCache:
+    return AnswerCache(get_processor().azure_embeddings)
+
+FORMULATION_PROMPT = PromptTemplate.from_template(
+    "You are an expert assistant. Convert the user's statement of facts into a clear, answerable question about insurance coverage.\n\n"
+    "Example 1:\nUser Statement: \"46M, knee surgery, Pune, 3-month policy\"\nQuestion: \"Is knee surgery covered by the policy?\"\n\n"
+    "Example 2:\nUser Statement: \"Car accident, frontal damage, Mumbai\"\nQuestion: \"What is the coverage for accidental damage to a car in Mumbai?\"\n\n"
+    "User Statement: \"{user_input}\"\nQuestion:"
+)
+
+@lru_cache(maxsize=1)
+def _get_formulation_chain():
+    return FORMULATION_PROMPT | get_processor().llm
+
+_formulate = cached_formulator(_get_formulation_chain)
+
+def mmr(query_vec: np.ndarray, doc_vecs: np.ndarray, k: int, lam: float = 0.5) -> List[int]:
+    """
+    Maximal marginal relevance over unit-length rows of `doc_vecs`: picks k rows that are
+    relevant to the query but not redundant with each other. One matrix-vector product per
+    pick, no Python-level loop over documents.
+    """
+    if k <= 0 or len(doc_vecs) == 0:
+        return []
+    doc_vecs = np.ascontiguousarray(doc_vecs, dtype=np.float32)
+    sims = doc_vecs @ np.asarray(query_vec, dtype=np.float32)
+    selected = [int(sims.argmax())]
+    # Highest similarity of each row to anything selected so far, updated after every pick
+    redundancy = doc_vecs @ doc_vecs[selected[0]]
+    for _ in range(min(k, len(doc_vecs)) - 1):
+        score = lam * sims - (1 - lam) * redundancy
+        score[selected] = -np.inf
+        pick = int(score.argmax())
+        selected.append(pick)
+        np.maximum(redundancy, doc_vecs @ doc_vecs[pick], out=redundancy)
+    return selected
+
 def parse_and_validate_response(response_content: str) -> Dict[str, Any]:
     """Robustly parses JSON from a string."""
     try:
-        json_start = response_content.find('{')
-        json_end = response_content.rfind('}') + 1
-        json_string = response_content[json_start:json_end]
-        return json.loads(json_string)
-    except (json.JSONDecodeError, IndexError):
+        return extract_json(response_content)
+    except ValueError:
         return {"error": "Failed to decode JSON from the LLM response.", "raw_response": response_content}
 
-def process_document_and_query(processor: DocumentProcessor, uploaded_file, user_input: str, **kwargs) -> Dict[str, Any]:
+def process_document_and_query(processor: DocumentProcessor, pdf_bytes: bytes, user_input: str, **kwargs) -> Dict[str, Any]:
     """Main pipeline to handle user input, process docs, and generate both structured and conversational responses."""
+    on_token = kwargs.pop('on_token', None)
+    if on_token is None:
+        return run_async(aprocess_document_and_query(processor, pdf_bytes, user_input, **kwargs))
+
+    return drain(stream_document_and_query(processor, pdf_bytes, user_input, **kwargs), on_token)
+
+def stream_document_and_query(processor: DocumentProcessor, pdf_bytes: bytes, user_input: str, **kwargs) -> Generator[str, None, Dict[str, Any]]:
+    """
+    Runs the pipeline and yields the answer text as it streams in, one new piece at a time
+    (suitable for st.write_stream). The structured result is the generator's return value.
+    """
+    # The pipeline runs on the shared I/O loop thread; streamed text is handed back
+    # through a queue so the caller (e.g. Streamlit) only ever runs on its own thread
+    updates = queue.Queue()
+    future = submit_async(aprocess_document_and_query(processor, pdf_bytes, user_input, on_token=updates.put, **kwargs))
+    sent = 0
+    while True:
+        try:
+            text = updates.get(timeout=0.05)
+        except queue.Empty:
+            if future.done() and updates.empty():
+                return future.result()
+            continue
+        yield text[sent:]
+        sent = len(text)
+
+async def aprocess_document_and_query(processor: DocumentProcessor, pdf_bytes: bytes, user_input: str, **kwargs) -> Dict[str, Any]:
+    """
+    Async version of process_document_and_query so several questions can run concurrently.
+    The vector store is built or reused (get_vectorstore) only after an answer-cache miss; a `doc_hash`
+    kwarg skips re-hashing the bytes and `insert_batch_size` tunes the Chroma writes of a first build.
+    `formulated_question` / `question_vector` kwargs skip formulation / query embedding when the caller already has them.
+    A `filename` kwarg is reported back in document_metadata.
+    An `on_token` kwarg, if given, is called with the answer text accumulated so far while it streams in.
+    An `mmr_lambda` kwarg switches retrieval to MMR over the top `4 * max_chunks` candidates
+    (1.0 = pure relevance, lower values favour diverse chunks).
+    Must run on the shared I/O loop: start it with http_pool.submit_async / run_async.
+    """
+    require_pool_loop()
     start_time = datetime.now()
     chunk_size = kwargs.get('chunk_size', 1000)
+    chunk_overlap = kwargs.get('chunk_overlap', 100)
     max_chunks = kwargs.get('max_chunks', 5)
+    on_token = kwargs.get('on_token')
+    prompt_template = kwargs.get('prompt_template', RAG_PROMPT_TEMPLATE)
+    mmr_lambda = kwargs.get('mmr_lambda')
     
     logger.info("--- Starting intelligent query processing ---")
     
     try:
         # --- NEW: Step 1 - Formulate a clear question from the user's input ---
-        formulation_prompt = PromptTemplate.from_template(
-            "You are an expert assistant. Convert the user's statement of facts into a clear, answerable question about insurance coverage.\n\n"
-            "Example 1:\nUser Statement: \"46M, knee surgery, Pune, 3-month policy\"\nQuestion: \"Is knee surgery covered by the policy?\"\n\n"
-            "Example 2:\nUser Statement: \"Car accident, frontal damage, Mumbai\"\nQuestion: \"What is the coverage for accidental damage to a car in Mumbai?\"\n\n"
-            "User Statement: \"{user_input}\"\nQuestion:"
-        )
-        question_formulation_chain = formulation_prompt | processor.llm
         logger.info(f"🧠 Formulating question from: '{user_input}'")
-        formulated_question = question_formulation_chain.invoke({"user_input": user_input}).content
+        formulated_question = kwargs.get('formulated_question')
+        if formulated_question is None and is_ready_question(user_input):
+            formulated_question = user_input
+        elif formulated_question is None:
+            formulated_question = await asyncio.to_thread(_formulate, user_input)
         logger.info(f"✅ Formulated Question: '{formulated_question}'")
 
-        # --- Step 2: RAG Pipeline ---
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            tmp_file_path = tmp_file.name
-        
-        loader = PyPDFLoader(tmp_file_path)
-        docs = loader.load()
-        os.remove(tmp_file_path)
+        # --- Answers to the same (or a paraphrased) question on this document are served from cache ---
+        doc_hash = kwargs.get('doc_hash') or document_hash(pdf_bytes)
+        answer_cache = _get_answer_cache()
+        # Answers are only reused for the same prompt and retrieval settings
+        scope = answer_scope(
+            "dynamic", prompt_template, max_chunks=max_chunks, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+            mmr_lambda=mmr_lambda
+        )
+        cached_answer, question_vector = await asyncio.to_thread(
+            answer_cache.lookup, doc_hash, scope, formulated_question, kwargs.get('question_vector')
+        )
+        if cached_answer is not None:
+            cached_answer["processing_statistics"] = {
+                **cached_answer.get("processing_statistics", {}),
+                'processing_time_seconds': (datetime.now() - start_time).total_seconds(),
+                'answer_cache_hit': True
+            }
+            return cached_answer
 
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=100)
-        chunks = text_splitter.split_documents(docs)
-        
-        vectorstore = Chroma.from_documents(documents=chunks, embedding=processor.azure_embeddings)
-        retriever = vectorstore.as_retriever(search_kwargs={'k': max_chunks})
+        # --- Step 2: RAG Pipeline (vector store is cached per document content) ---
+        index, doc_stats = await asyncio.to_thread(
+            get_vectorstore, pdf_bytes, processor.azure_embeddings, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+            insert_batch_size=kwargs.get('insert_batch_size', INSERT_BATCH_SIZE), doc_hash=doc_hash
+        )
 
-        rag_prompt = PromptTemplate.from_template(kwargs.get('prompt_template', 
-            "You are an expert insurance policy analyst. Based *only* on the CONTEXT provided, answer the user's QUESTION. "
-            "Generate a JSON object with the schema: {{\"decision\": \"yes/no/partially\", \"amount\": \"coverage amount or 'Not Specified'\", \"justification\": \"explanation quoting context\", \"source_clause\": \"clause number\"}}\n\n"
-            "CONTEXT: {context}\nQUESTION: {question}\nANSWER (JSON):"
-        ))
+        rag_prompt = PromptTemplate.from_template(prompt_template)
 
-        rag_chain = ({"context": retriever, "question": RunnablePassthrough()} | rag_prompt | processor.llm)
-        response_from_llm = rag_chain.invoke(formulated_question)
-        structured_response = parse_and_validate_response(response_from_llm.content)
+        # Retrieve once with the question vector from the cache lookup; the same docs
+        # feed the prompt and are returned as evidence
+        if mmr_lambda is None:
+            source_documents = index.search(question_vector, max_chunks)
+        else:
+            candidates = index.top_ids(question_vector, 4 * max_chunks)
+            query_vec = np.asarray(question_vector, dtype=np.float32)
+            picks = mmr(query_vec / np.linalg.norm(query_vec), index.vectors(candidates), max_chunks, mmr_lambda)
+            source_documents = [index.documents[candidates[i]] for i in picks]
+        response_content = ""
+        async for chunk in (rag_prompt | processor.llm).astream({"context": format_docs(source_documents), "question": formulated_question}):
+            response_content += chunk.content
+            if on_token:
+                on_token(response_content)
+        structured_response = parse_and_validate_response(response_content)
 
         if "error" in structured_response:
             return structured_response
 
-        # --- NEW: Step 3 - Generate Conversational Summary ---
-        summary_prompt = PromptTemplate.from_template(
-            "Based on the following analysis, provide a simple, one-sentence conversational answer.\n"
-            "Analysis Decision: {decision}\nJustification: {justification}\n"
-            "Example: If the decision is 'yes' for knee surgery, respond with 'Yes, knee surgery is covered under the policy.'\n"
-            "Conversational Answer:"
-        )
-        summary_chain = summary_prompt | processor.llm
-        conversational_summary = summary_chain.invoke(structured_response).content
-
-        # --- Step 4: Assemble Final Response ---
+        # --- Step 3: Assemble Final Response (conversational_summary is part of the JSON answer) ---
         processing_time = (datetime.now() - start_time).total_seconds()
         structured_response.update({
-            "conversational_summary": conversational_summary,
             "formulated_question": formulated_question,
-            "source_documents": retriever.invoke(formulated_question),
-            "document_metadata": {'filename': uploaded_file.name, 'total_pages': len(docs)},
-            "processing_statistics": {'processing_time_seconds': processing_time, 'chunks_processed': len(chunks)}
+            "source_documents": source_documents,
+            "document_metadata": {'filename': kwargs.get('filename'), 'total_pages': doc_stats['total_pages'], 'document_hash': doc_stats['document_hash']},
+            "processing_statistics": {'processing_time_seconds': processing_time, 'chunks_processed': doc_stats['chunk_count']}
         })
+        await asyncio.to_thread(answer_cache.store, doc_stats['document_hash'], scope, formulated_question, question_vector, structured_response)
         
         return structured_response
 
@@ -132,9 +231,49 @@ def process_document_and_query(processor: DocumentProcessor, uploaded_file, user
         logger.error(f"Error processing document: {str(e)}")
         return {"error": f"Processing failed: {str(e)}"}
 
-# Dummy functions for the other tabs, can be enhanced later
-def process_multiple_queries(processor, uploaded_file, queries, **kwargs):
-    return [process_document_and_query(processor, uploaded_file, q, **kwargs) for q in queries]
+def _norm(query: str) -> str:
+    """Case- and whitespace-insensitive form used to spot repeated queries."""
+    return re.sub(r"\s+", " ", query.strip().lower())
+
+async def process_multiple_queries_async(processor, pdf_bytes: bytes, queries, **kwargs):
+    """
+    Answers every query against one shared vector store, all queries in flight at once.
+    Queries that differ only in case or whitespace are answered once; every duplicate
+    slot in the returned list gets that same answer.
+    Takes the same kwargs as aprocess_document_and_query (e.g. `doc_hash`, `insert_batch_size`).
+    Must run on the shared I/O loop: start it with http_pool.submit_async / run_async.
+    """
+    require_pool_loop()
+    # Hash once for every query. The vector store is only opened or built by the queries
+    # that miss the answer cache; get_vectorstore's per-document lock means it is built once
+    kwargs['doc_hash'] = kwargs.get('doc_hash') or await asyncio.to_thread(document_hash, pdf_bytes)
+
+    slot: Dict[str, int] = {}
+    unique_queries: List[str] = []
+    for q in queries:
+        key = _norm(q)
+        if key not in slot:
+            slot[key] = len(unique_queries)
+            unique_queries.append(q)
+
+    async def formulate(q):
+        return q if is_ready_question(q) else await asyncio.to_thread(_formulate, q)
+
+    questions = await asyncio.gather(*[formulate(q) for q in unique_queries])
+    # One embeddings request for every question instead of one round-trip each
+    vectors = np.asarray(await processor.azure_embeddings.aembed_documents(questions), dtype=np.float32)
+    results = await asyncio.gather(*[
+        aprocess_document_and_query(
+            processor, pdf_bytes, q,
+            formulated_question=fq, question_vector=v, **kwargs
+        )
+        for q, fq, v in zip(unique_queries, questions, vectors)
+    ])
+    return [results[slot[_norm(q)]] for q in queries]
+
+def process_multiple_queries(processor, pdf_bytes: bytes, queries, **kwargs):
+    # Runs on the shared I/O loop rather than asyncio.run, so the pooled async HTTP client stays usable
+    return run_async(process_multiple_queries_async(processor, pdf_bytes, queries, **kwargs))
 
-def get_document_summary(processor, uploaded_file, **kwargs):
-    return process_document_and_query(processor, "Generate a detailed summary of this document.", **kwargs)
\ No newline at end of file
+def get_document_summary(processor, pdf_bytes: bytes, **kwargs):
+    return process_document_and_query(processor, pdf_bytes, "Generate a detailed summary of this document.", **kwargs)
\ No newline at end of file
@@ -13,41 +13,69 @@ from dotenv import load_dotenv
 # Load credentials early
 load_dotenv()
 
+REQUIRED_VARS = ("EMBEDDING_AZURE_API_KEY", "EMBEDDING_AZURE_ENDPOINT", "GENERATION_AZURE_API_KEY", "GENERATION_AZURE_ENDPOINT")
+# One snapshot of the environment per script run, taken right after .env is loaded
+_MISSING = tuple(var for var in REQUIRED_VARS if not os.environ.get(var))
+
+@st.cache_resource(show_spinner=False)
+def _get_processor():
+    """Azure clients shared by every session and rerun, so their connection pools stay warm."""
+    from dynamic import get_processor
+    return get_processor()
+
+@st.cache_data(show_spinner=False)
+def _render_missing_creds(missing: tuple) -> str:
+    """Credentials error text, built once per distinct set of missing variables."""
+    listed = "\n".join(f"- `{var}`" for var in missing)
+    return f"🔑 Missing Azure OpenAI Credentials in your secrets. Please add them to continue:\n\n{listed}"
+
 # --- Main App Logic ---
 def main_app():
     # Check for credentials before importing the backend
-    required_vars = ["EMBEDDING_AZURE_API_KEY", "EMBEDDING_AZURE_ENDPOINT", "GENERATION_AZURE_API_KEY", "GENERATION_AZURE_ENDPOINT"]
-    if any(not os.getenv(var) for var in required_vars):
-        st.error("🔑 Missing Azure OpenAI Credentials in your secrets. Please add them to continue.")
+    if _MISSING:
+        st.error(_render_missing_creds(_MISSING))
         st.stop()
     
-    # Import backend now that credentials are confirmed
-    from dynamic import DocumentProcessor, process_document_and_query, process_multiple_queries, get_document_summary
-    
     st.set_page_config(page_title="Intelligent Document Analyst", page_icon="🤖", layout="wide")
     st.title("🤖 Intelligent Document Analyst")
 
-    # Instantiate the processor once
-    if 'processor' not in st.session_state:
-        try:
-            st.session_state.processor = DocumentProcessor()
-        except ValueError as e:
-            st.error(str(e))
-            st.stop()
-    
-    processor = st.session_state.processor
+    # Indexing settings; lower the batch size if Streamlit Cloud runs short of memory while indexing
+    with st.sidebar:
+        st.header("⚙️ Indexing")
+        insert_batch_size = st.slider("Chroma insert batch size", min_value=50, max_value=500, value=200, step=50)
 
     # Main UI
     uploaded_file = st.file_uploader("Upload your document (PDF)", type="pdf")
 
     if uploaded_file:
-        st.success(f"✅ Document '{uploaded_file.name}' ready for analysis.")
+        st.success(f"✅ Document '{uploaded_file.name}' ({uploaded_file.size} bytes) ready for analysis.")
         user_input = st.text_input("Enter your query or statement of facts (e.g., '46M, knee surgery, Pune'):", "46M, knee surgery, Pune, 3-month policy")
 
         if st.button("Analyze Query"):
             if user_input:
                 with st.spinner("Analyzing..."):
-                    response = process_document_and_query(processor, uploaded_file, user_input)
+                    # The backend (LangChain, Chroma, OpenAI SDK) is imported on first use so the
+                    # upload screen paints without waiting for it
+                    from dynamic import stream_document_and_query
+                    from streaming import show_answer_stream
+                    from document_store import document_hash
+
+                    # Instantiate the processor once per process; a failed attempt is not cached and is retried on the next click
+                    try:
+                        processor = _get_processor()
+                    except ValueError as e:
+                        st.error(str(e))
+                        st.stop()
+
+                    # doc_id is the cache key for everything derived from this PDF. The backend builds
+                    # (or reuses) the vector store only after an answer-cache miss, inside its own error handling
+                    pdf_bytes = uploaded_file.getvalue()
+                    doc_id = document_hash(pdf_bytes)
+
+                    response = show_answer_stream(stream_document_and_query(
+                        processor, pdf_bytes, user_input, doc_hash=doc_id,
+                        insert_batch_size=insert_batch_size, filename=uploaded_file.name
+                    ))
 
                     if "error" not in response:
                         # --- NEW: Display conversational summary first ---
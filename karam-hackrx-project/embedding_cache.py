@@ -0,0 +1,48 @@
+"""
+Disk-backed, content-addressed cache of embeddings keyed by BLAKE3(model + text)
+"""
+import os
+import sqlite3
+import threading
+from typing import Dict, List
+
+import numpy as np
+from blake3 import blake3
+
+# SQLite's default limit on bound parameters is 999
+_MAX_KEYS_PER_QUERY = 500
+
+class EmbeddingCache:
+    """
+    Lets re-uploads, restarts and boilerplate shared between policies skip the embeddings API.
+    Vectors are stored as raw float32 bytes and read back with np.frombuffer, without copying.
+    """
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text: str, model: str) -> str:
+        # The model is part of the key so vectors from different models or sizes never mix
+        return blake3(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), _MAX_KEYS_PER_QUERY):
+                batch = keys[i:i + _MAX_KEYS_PER_QUERY]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                )
+                found.update((key, np.frombuffer(vector, dtype=np.float32)) for key, vector in rows)
+        return found
+
+    def put_many(self, vectors: Dict[str, List[float]]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in vectors.items()]
+            )
+            self._conn.commit()
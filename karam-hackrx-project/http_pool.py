@@ -0,0 +1,38 @@
+"""
+Pooled HTTP clients shared by every Azure OpenAI client in the process, and the
+event loop all async calls run on
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+
+import httpx
+
+# Kept-alive connections let repeat calls to Azure skip the TCP and TLS handshake
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+shared_http = httpx.Client(limits=HTTP_LIMITS, timeout=30.0)
+
+# An httpx.AsyncClient is bound to the event loop it first runs on, so every coroutine
+# goes through one long-lived loop instead of a fresh asyncio.run() loop per call
+_loop = asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, name="azure-io-loop", daemon=True).start()
+shared_async_http = httpx.AsyncClient(limits=HTTP_LIMITS, timeout=30.0)
+
+def require_pool_loop() -> None:
+    """
+    Raises unless called from a coroutine running on the shared loop. Coroutines that use
+    shared_async_http must be started with submit_async / run_async, not asyncio.run().
+    """
+    if asyncio.get_running_loop() is not _loop:
+        raise RuntimeError(
+            "This coroutine uses the pooled async HTTP client, which is bound to http_pool's event loop; "
+            "start it with http_pool.submit_async() or run_async() instead of awaiting it on another loop."
+        )
+
+def submit_async(coro) -> Future:
+    """Schedules the coroutine on the shared loop and returns a concurrent Future."""
+    return asyncio.run_coroutine_threadsafe(coro, _loop)
+
+def run_async(coro):
+    """Runs the coroutine on the shared loop and blocks until it finishes. Never call from the loop itself."""
+    return submit_async(coro).result()
@@ -1,5 +1,4 @@
 import streamlit as st
-from app import get_policy_analysis
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -15,13 +14,22 @@ st.write("Upload a policy document and ask a question in plain English to get an
 uploaded_file = st.file_uploader("1. Upload your policy document (PDF)", type="pdf")
 
 if uploaded_file:
-    user_input = st.text_input("2. Enter your query (e.g., '46M, knee surgery, Pune')", "46M, knee surgery, Pune")
+    # The widget owns the query in session state; presets can set st.session_state["query_text"] directly.
+    # The default is seeded there rather than passed as value=, which Streamlit rejects alongside a state write.
+    st.session_state.setdefault("query_text", "46M, knee surgery, Pune")
+    st.text_input("2. Enter your query (e.g., '46M, knee surgery, Pune')", key="query_text")
 
     if st.button("Analyze Query"):
+        user_input = st.session_state["query_text"]
         if user_input:
             with st.spinner("Analyzing document..."):
                 try:
-                    response = get_policy_analysis(uploaded_file, user_input)
+                    # Imported on first use: LangChain, Chroma and the OpenAI SDK take seconds to load,
+                    # and the upload screen should not wait for them
+                    from app import stream_policy_analysis
+                    from streaming import show_answer_stream
+
+                    response = show_answer_stream(stream_policy_analysis(uploaded_file.getvalue(), user_input))
                     
                     if "error" not in response:
                         st.subheader("🎯 Analysis Result")
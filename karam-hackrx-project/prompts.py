@@ -0,0 +1,118 @@
+"""
+Prompt text and JSON answer parsing shared by app.py and dynamic.py
+"""
+import re
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator
+
+import orjson
+
+# Everything before CONTEXT is identical on every request. Azure OpenAI caches a
+# prompt prefix once it reaches 1024 identical leading tokens, so keep the static
+# instructions and examples first and above that size; only CONTEXT and QUESTION vary.
+RAG_PROMPT_PREAMBLE = """You are an expert insurance policy analyst. Based *only* on the CONTEXT provided, answer the user's QUESTION.
+
+Rules:
+1. Use only the CONTEXT. If the CONTEXT does not address the QUESTION, answer "no" only when it explicitly excludes the case; otherwise answer "partially" and say what is missing.
+2. Quote the exact wording of the policy in the justification, in double quotes, and keep it under 80 words.
+3. The amount is the sum insured, sub-limit, co-payment or benefit amount that applies, with its currency exactly as written. Use 'Not Specified' when no amount is stated.
+4. The source clause is the clause, section or definition number closest to the quoted text, for example "4.1.2" or "Section C, Part II". Use 'Not Specified' when none is printed.
+5. Waiting periods, exclusions and sub-limits override a general benefit: a covered treatment still inside its waiting period is "no", and a covered treatment with a sub-limit is "partially".
+6. The conversational summary is one plain-English sentence a customer would understand, e.g. "Yes, knee surgery is covered under the policy."
+7. Reply with the JSON object only, no markdown fences and no text before or after it.
+
+Generate a JSON object with the schema: {{"decision": "yes/no/partially", "amount": "coverage amount or 'Not Specified'", "justification": "explanation quoting context", "source_clause": "clause number", "conversational_summary": "one-sentence plain-English answer"}}
+
+Example 1:
+CONTEXT: 3.1.1 In-patient Hospitalisation: The Company shall indemnify Medical Expenses incurred for Hospitalisation of the Insured Person for a minimum period of 24 consecutive hours, up to the Sum Insured specified in the Policy Schedule.
+QUESTION: Is a three-day hospital stay for pneumonia covered?
+ANSWER (JSON): {{"decision": "yes", "amount": "Up to the Sum Insured in the Policy Schedule", "justification": "Hospitalisation longer than 24 hours is covered: \\"The Company shall indemnify Medical Expenses incurred for Hospitalisation of the Insured Person for a minimum period of 24 consecutive hours\\".", "source_clause": "3.1.1", "conversational_summary": "Yes, a hospital stay of more than 24 hours for pneumonia is covered up to your Sum Insured."}}
+
+Example 2:
+CONTEXT: 4.2 Specified Disease/Procedure Waiting Period: Expenses related to the treatment of the listed conditions, surgeries and treatments shall be excluded until the expiry of 24 months of continuous coverage after the date of inception of the first policy. (ix) Joint replacement surgery, arthroscopic knee surgery.
+QUESTION: Is knee surgery covered for a 46-year-old on a 3-month-old policy?
+ANSWER (JSON): {{"decision": "no", "amount": "Not Specified", "justification": "Knee surgery is subject to a waiting period: \\"shall be excluded until the expiry of 24 months of continuous coverage\\", and the policy is only 3 months old.", "source_clause": "4.2 (ix)", "conversational_summary": "No, knee surgery is not covered until the policy has been active for 24 months."}}
+
+Example 3:
+CONTEXT: 3.1.6 Cataract Treatment: The Company shall indemnify expenses incurred for treatment of cataract, subject to a limit of 10% of the Sum Insured or INR 50,000, whichever is lower, per eye, in a Policy Year.
+QUESTION: What is the coverage for cataract surgery on one eye?
+ANSWER (JSON): {{"decision": "partially", "amount": "10% of Sum Insured or INR 50,000 per eye, whichever is lower", "justification": "Cataract treatment is covered with a sub-limit: \\"subject to a limit of 10% of the Sum Insured or INR 50,000, whichever is lower, per eye\\".", "source_clause": "3.1.6", "conversational_summary": "Cataract surgery is covered, but only up to 10% of the Sum Insured or INR 50,000 per eye, whichever is lower."}}
+
+Example 4:
+CONTEXT: 4.3 Standard Exclusions (Excl 07): Expenses related to any treatment necessitated due to participation as a professional in hazardous or adventure sports, including but not limited to para-jumping, rock climbing and scuba diving.
+QUESTION: Is an injury from recreational trekking covered?
+ANSWER (JSON): {{"decision": "partially", "amount": "Not Specified", "justification": "The exclusion only applies to professionals: \\"participation as a professional in hazardous or adventure sports\\". Recreational trekking is not listed, but the CONTEXT does not state the benefit that would apply.", "source_clause": "4.3 (Excl 07)", "conversational_summary": "Recreational trekking is not excluded, but the policy text provided does not confirm the benefit that would pay for the injury."}}
+
+Example 5:
+CONTEXT: 2.21 Co-payment: A co-payment of 20% shall apply on each admissible claim if the Insured Person is aged 61 years or above at the time of inception of the Policy.
+QUESTION: Does a 65-year-old pay anything towards an admissible claim?
+ANSWER (JSON): {{"decision": "partially", "amount": "20% co-payment on each admissible claim", "justification": "Claims are paid net of a co-payment: \\"A co-payment of 20% shall apply on each admissible claim if the Insured Person is aged 61 years or above\\".", "source_clause": "2.21", "conversational_summary": "Yes, at 65 you pay a 20% co-payment on every admissible claim."}}
+
+Example 6:
+CONTEXT: 3.1.4 Road Ambulance: The Company shall indemnify the reasonable expenses incurred on a road ambulance for transferring the Insured Person to the nearest Hospital, up to INR 2,000 per Hospitalisation.
+QUESTION: Will the policy pay for an ambulance after a car accident in Mumbai?
+ANSWER (JSON): {{"decision": "yes", "amount": "Up to INR 2,000 per Hospitalisation", "justification": "Road ambulance transfer is covered: \\"The Company shall indemnify the reasonable expenses incurred on a road ambulance ... up to INR 2,000 per Hospitalisation\\".", "source_clause": "3.1.4", "conversational_summary": "Yes, a road ambulance to the nearest hospital is covered up to INR 2,000 per hospitalisation."}}
+"""
+
+RAG_PROMPT_TEMPLATE = RAG_PROMPT_PREAMBLE + "\nCONTEXT: {context}\nQUESTION: {question}\nANSWER (JSON):"
+
+# Stable `user` value sent with every completion so requests land on the same prompt cache
+PROMPT_CACHE_USER = "policy-analyst-v1"
+
+def is_ready_question(user_input: str) -> bool:
+    """Questions and direct instructions are sent to retrieval as-is, skipping the formulation call."""
+    text = user_input.strip()
+    return text.endswith("?") or text.startswith("Generate a")
+
+def cached_formulator(get_chain: Callable[[], Any]) -> Callable[[str], str]:
+    """
+    Wraps a backend's formulation chain (built lazily by `get_chain`) in a function that turns
+    the user's statement into a question; repeated inputs skip the LLM call.
+    """
+    @lru_cache(maxsize=1024)
+    def formulate(user_input: str) -> str:
+        return get_chain().invoke({"user_input": user_input}).content
+    return formulate
+
+# Greedy match from the first '{' to the last '}', one pass over the response
+_JSON_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+def _balanced_objects(text: str) -> Iterator[str]:
+    """Yields each top-level {...} span, ignoring braces inside JSON strings."""
+    depth, start, in_string, escaped = 0, None, False, False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = depth > 0
+        elif ch == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif ch == "}" and depth > 0:
+            depth -= 1
+            if depth == 0:
+                yield text[start:i + 1]
+
+def extract_json(response_content: str) -> Dict[str, Any]:
+    """
+    Parses the JSON object out of an LLM response. Falls back to a brace-balance walk
+    when stray braces around the object break the fast path. Raises ValueError on failure.
+    """
+    match = _JSON_RE.search(response_content)
+    if match is None:
+        raise ValueError("No JSON object found in the LLM response.")
+    try:
+        return orjson.loads(match.group(0))
+    except orjson.JSONDecodeError:
+        for candidate in _balanced_objects(response_content):
+            try:
+                return orjson.loads(candidate)
+            except orjson.JSONDecodeError:
+                continue
+        raise
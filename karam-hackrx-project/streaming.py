@@ -0,0 +1,38 @@
+"""
+Helpers for consuming the answer generators of app.py and dynamic.py
+"""
+from typing import Any, Callable, Dict, Generator, Optional
+
+AnswerStream = Generator[str, None, Dict[str, Any]]
+
+def drain(stream: AnswerStream, on_token: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    """
+    Runs an answer generator to completion and returns its structured result.
+    `on_token`, if given, is called with the answer text accumulated so far after each piece.
+    """
+    text = ""
+    while True:
+        try:
+            text += next(stream)
+        except StopIteration as stop:
+            return stop.value
+        if on_token:
+            on_token(text)
+
+def show_answer_stream(stream: AnswerStream) -> Dict[str, Any]:
+    """
+    Shows the raw answer in the Streamlit page as it streams in, clears it once complete
+    and returns the structured result for the caller to render.
+    """
+    # Imported here so the backends can use drain() without pulling in Streamlit
+    import streamlit as st
+
+    response: Dict[str, Any] = {}
+    def pieces():
+        response.update((yield from stream))
+
+    placeholder = st.empty()
+    with placeholder.container():
+        st.write_stream(pieces())
+    placeholder.empty()
+    return response
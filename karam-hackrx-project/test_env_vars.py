@@ -8,19 +8,20 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Check if all required variables are present
-required_vars = [
+required_vars = (
     "EMBEDDING_AZURE_API_KEY",
-    "EMBEDDING_AZURE_ENDPOINT", 
+    "EMBEDDING_AZURE_ENDPOINT",
     "GENERATION_AZURE_API_KEY",
     "GENERATION_AZURE_ENDPOINT"
-]
+)
+env = os.environ
 
 print("🔍 Checking environment variables...")
 print("=" * 50)
 
 all_present = True
 for var in required_vars:
-    value = os.getenv(var)
+    value = env.get(var)
     if value:
         # Show first 10 and last 10 characters of API keys for security
         if "API_KEY" in var: